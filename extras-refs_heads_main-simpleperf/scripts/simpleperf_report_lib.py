@@ -20,13 +20,19 @@
 
 """
 
+import array
 import collections
 from collections import namedtuple
 import ctypes as ct
 import etm_types as etm
+import mmap
+import operator
+import os
 from pathlib import Path
+import re
 import struct
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+import warnings
 
 from simpleperf_utils import (bytes_to_str, get_host_binary_path, is_windows, log_exit,
                               str_to_bytes, ReportLibOptions)
@@ -43,7 +49,9 @@ def _char_pt(s: str) -> bytes:
 
 
 def _char_pt_to_str(char_pt: ct.c_char_p) -> str:
-    return bytes_to_str(char_pt)
+    # Same as bytes_to_str(), but inlined. It is called for each string field accessed on
+    # samples and callchain entries.
+    return char_pt.decode('utf-8') if char_pt else ''
 
 
 def _check(cond: bool, failmsg: str):
@@ -51,6 +59,13 @@ def _check(cond: bool, failmsg: str):
         raise RuntimeError(failmsg)
 
 
+def _struct_view(view: Optional[ct.Structure], addr: int, struct_type: type) -> ct.Structure:
+    """ Return a struct_type view of the memory at addr, reusing view if it is already there. """
+    if view is not None and ct.addressof(view) == addr:
+        return view
+    return struct_type.from_address(addr)
+
+
 class SampleStruct(ct.Structure):
     """ Instance of a sample in perf.data.
         ip: the program counter of the thread generating the sample.
@@ -279,6 +294,23 @@ class ReportLibStructure(ct.Structure):
     _fields_ = []
 
 
+# A sample with its event, symbol and callchain, returned by GetNextSampleFull().
+FullSample = namedtuple('FullSample', ['sample', 'event', 'symbol', 'callchain'])
+
+
+def _can_merge_regex(pattern: str) -> bool:
+    """ Return if a regex can be joined with others into one alternation without changing its
+        meaning. Python's re is only used to check for capturing groups and unbalanced
+        parentheses. The regex still runs in the native lib.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            return re.compile(pattern).groups == 0
+        except re.error:
+            return False
+
+
 def SetReportOptionsForReportLib(report_lib, options: ReportLibOptions):
     if options.proguard_mapping_files:
         for file_path in options.proguard_mapping_files:
@@ -286,7 +318,21 @@ def SetReportOptionsForReportLib(report_lib, options: ReportLibOptions):
     if options.show_art_frames:
         report_lib.ShowArtFrames(True)
     if options.remove_method:
+        # Each removed method regex is tried on each method. So join regexes into one, which is
+        # matched once per method. Regexes with groups are kept apart, because joining them
+        # renumbers groups used by backreferences.
+        separate_names = []
+        merged_names = []
         for name in options.remove_method:
+            (merged_names if _can_merge_regex(name) else separate_names).append(name)
+        if len(merged_names) > 1:
+            try:
+                report_lib.RemoveMethod('|'.join(f'(?:{name})' for name in merged_names))
+                merged_names = []
+            except RuntimeError:
+                # Add them one by one to report which regex is invalid.
+                pass
+        for name in merged_names + separate_names:
             report_lib.RemoveMethod(name)
     if options.trace_offcpu:
         report_lib.SetTraceOffCpuMode(options.trace_offcpu)
@@ -296,6 +342,41 @@ def SetReportOptionsForReportLib(report_lib, options: ReportLibOptions):
         report_lib.AggregateThreads(options.aggregate_threads)
 
 
+SAMPLE_FIELDS = ('ip', 'pid', 'tid', 'thread_comm', 'time', 'in_kernel', 'cpu', 'period')
+# array typecodes of numeric sample fields, matching their types in SampleStruct.
+SAMPLE_COLUMN_TYPECODES = {'ip': 'Q', 'pid': 'I', 'tid': 'I', 'time': 'Q', 'in_kernel': 'B',
+                           'cpu': 'I', 'period': 'Q'}
+
+
+def IterSamplesForReportLib(report_lib, fields: Sequence[str]) -> Iterator[Tuple]:
+    getters = []
+    for field in fields:
+        if field == 'event_name':
+            getters.append(lambda _: report_lib.GetEventOfCurrentSample().name)
+        elif field in SAMPLE_FIELDS:
+            getters.append(operator.attrgetter(field))
+        else:
+            raise ValueError(f'unknown sample field: {field}')
+    while True:
+        sample = report_lib.GetNextSample()
+        if not sample:
+            return
+        yield tuple(getter(sample) for getter in getters)
+
+
+def GetSampleColumnsForReportLib(
+        report_lib, fields: Sequence[str]) -> Dict[str, Union[array.array, List[str]]]:
+    columns = []
+    for field in fields:
+        typecode = SAMPLE_COLUMN_TYPECODES.get(field)
+        columns.append(array.array(typecode) if typecode else [])
+    appends = [column.append for column in columns]
+    for values in IterSamplesForReportLib(report_lib, fields):
+        for append, value in zip(appends, values):
+            append(value)
+    return dict(zip(fields, columns))
+
+
 # pylint: disable=invalid-name
 class ReportLib(object):
     """ Read contents from perf.data. """
@@ -328,14 +409,16 @@ class ReportLib(object):
         self._SetSampleFilterFunc.restype = ct.c_bool
         self._AggregateThreadsFunc = self._lib.AggregateThreads
         self._AggregateThreadsFunc.restype = ct.c_bool
+        # The native lib reuses one buffer for the current sample and one for its callchain. So
+        # they are returned as addresses, and their struct views are reused across samples.
         self._GetNextSampleFunc = self._lib.GetNextSample
-        self._GetNextSampleFunc.restype = ct.POINTER(SampleStruct)
+        self._GetNextSampleFunc.restype = ct.c_void_p
         self._GetEventOfCurrentSampleFunc = self._lib.GetEventOfCurrentSample
         self._GetEventOfCurrentSampleFunc.restype = ct.POINTER(EventStruct)
         self._GetSymbolOfCurrentSampleFunc = self._lib.GetSymbolOfCurrentSample
         self._GetSymbolOfCurrentSampleFunc.restype = ct.POINTER(SymbolStruct)
         self._GetCallChainOfCurrentSampleFunc = self._lib.GetCallChainOfCurrentSample
-        self._GetCallChainOfCurrentSampleFunc.restype = ct.POINTER(CallChainStructure)
+        self._GetCallChainOfCurrentSampleFunc.restype = ct.c_void_p
         self._GetEventCountersOfCurrentSampleFunc = self._lib.GetEventCountersOfCurrentSample
         self._GetEventCountersOfCurrentSampleFunc.restype = ct.POINTER(EventCountersViewStructure)
         self._GetTracingDataOfCurrentSampleFunc = self._lib.GetTracingDataOfCurrentSample
@@ -366,6 +449,10 @@ class ReportLib(object):
 
         self.meta_info: Optional[Dict[str, str]] = None
         self.current_sample: Optional[SampleStruct] = None
+        self._sample_view: Optional[SampleStruct] = None
+        self._callchain_view: Optional[CallChainStructure] = None
+        # Map from event name to its tracing fields by name.
+        self._tracing_fields: Dict[str, Dict[str, TracingFieldFormatStruct]] = {}
         self.record_cmd: Optional[str] = None
         self.callback: Optional[ct._FuncPointer] = None
 
@@ -397,7 +484,11 @@ class ReportLib(object):
         _check(cond, 'Failed to set symbols directory')
 
     def SetRecordFile(self, record_file: str):
-        """ Set the path of record file, like perf.data."""
+        """ Set the path of record file, like perf.data.
+            It only reads the file header and feature sections. Samples are read by
+            GetNextSample(). So querying metadata like build ids, meta info and record cmd
+            doesn't pay for reading samples.
+        """
         cond: bool = self._SetRecordFileFunc(self.getInstance(), _char_pt(record_file))
         _check(cond, 'Failed to set record file')
 
@@ -494,16 +585,45 @@ class ReportLib(object):
 
     def GetNextSample(self) -> Optional[SampleStruct]:
         """ Return the next sample. If no more samples, return None. """
-        psample = self._GetNextSampleFunc(self.getInstance())
-        if _is_null(psample):
+        sample_addr = self._GetNextSampleFunc(self.getInstance())
+        if sample_addr is None:
             self.current_sample = None
         else:
-            self.current_sample = psample[0]
+            self._sample_view = _struct_view(self._sample_view, sample_addr, SampleStruct)
+            self.current_sample = self._sample_view
         return self.current_sample
 
     def GetCurrentSample(self) -> Optional[SampleStruct]:
         return self.current_sample
 
+    def GetNextSampleFull(self) -> Optional[FullSample]:
+        """ Return the next sample with its event, symbol and callchain. If no more samples,
+            return None. Like the results of GetEventOfCurrentSample() and others, they are
+            only valid until the next sample is read.
+        """
+        sample = self.GetNextSample()
+        if sample is None:
+            return None
+        instance = self.getInstance()
+        event = self._GetEventOfCurrentSampleFunc(instance)
+        symbol = self._GetSymbolOfCurrentSampleFunc(instance)
+        assert not _is_null(event) and not _is_null(symbol)
+        return FullSample(sample, event[0], symbol[0], self.GetCallChainOfCurrentSample())
+
+    def IterSamples(self, fields: Sequence[str]) -> Iterator[Tuple]:
+        """ Iterate over the remaining samples, yielding a tuple of the selected fields for each
+            sample. A field can be an attribute of SampleStruct or 'event_name'. Values are
+            copied out of the native sample, so they stay valid after reading the next sample.
+        """
+        return IterSamplesForReportLib(self, fields)
+
+    def GetSampleColumns(self, fields: Sequence[str]) -> Dict[str, Union[array.array, List[str]]]:
+        """ Read the remaining samples, and return a map from each selected field to a column
+            of its values, one per sample. Numeric fields are stored in compact arrays, and string
+            fields (thread_comm and event_name) in lists.
+        """
+        return GetSampleColumnsForReportLib(self, fields)
+
     def GetEventOfCurrentSample(self) -> EventStruct:
         event = self._GetEventOfCurrentSampleFunc(self.getInstance())
         assert not _is_null(event)
@@ -515,9 +635,21 @@ class ReportLib(object):
         return symbol[0]
 
     def GetCallChainOfCurrentSample(self) -> CallChainStructure:
-        callchain = self._GetCallChainOfCurrentSampleFunc(self.getInstance())
-        assert not _is_null(callchain)
-        return callchain[0]
+        callchain_addr = self._GetCallChainOfCurrentSampleFunc(self.getInstance())
+        assert callchain_addr is not None
+        self._callchain_view = _struct_view(
+            self._callchain_view, callchain_addr, CallChainStructure)
+        return self._callchain_view
+
+    def GetCallChainDsoNamesOfCurrentSample(self) -> List[str]:
+        """ Return dso names of all callchain entries of the current sample. """
+        callchain = self.GetCallChainOfCurrentSample()
+        return [entry.symbol.dso_name for entry in callchain.entries[:callchain.nr]]
+
+    def GetCallChainSymbolNamesOfCurrentSample(self) -> List[str]:
+        """ Return symbol names of all callchain entries of the current sample. """
+        callchain = self.GetCallChainOfCurrentSample()
+        return [entry.symbol.symbol_name for entry in callchain.entries[:callchain.nr]]
 
     def GetEventCountersOfCurrentSample(self) -> EventCountersViewStructure:
         event_counters = self._GetEventCountersOfCurrentSampleFunc(self.getInstance())
@@ -528,13 +660,32 @@ class ReportLib(object):
         data = self._GetTracingDataOfCurrentSampleFunc(self.getInstance())
         if _is_null(data):
             return None
-        event = self.GetEventOfCurrentSample()
         result = collections.OrderedDict()
-        for i in range(event.tracing_data_format.field_count):
-            field = event.tracing_data_format.fields[i]
-            result[field.name] = field.parse_value(data)
+        for name, field in self._GetTracingFields(self.GetEventOfCurrentSample()).items():
+            result[name] = field.parse_value(data)
         return result
 
+    def GetTracingFieldOfCurrentSample(self, field_name: str) -> Any:
+        """ Return the value of one field in the tracing data of the current sample, without
+            parsing the other fields. Return None if the sample has no tracing data. Raise
+            KeyError if the event has no such field.
+        """
+        data = self._GetTracingDataOfCurrentSampleFunc(self.getInstance())
+        if _is_null(data):
+            return None
+        return self._GetTracingFields(self.GetEventOfCurrentSample())[field_name].parse_value(data)
+
+    def _GetTracingFields(self, event: EventStruct) -> Dict[str, TracingFieldFormatStruct]:
+        fields = self._tracing_fields.get(event.name)
+        if fields is None:
+            data_format = event.tracing_data_format
+            fields = {}
+            for i in range(data_format.field_count):
+                field = data_format.fields[i]
+                fields[field.name] = field
+            self._tracing_fields[event.name] = fields
+        return fields
+
     def GetProcessNameOfCurrentSample(self) -> str:
         return _char_pt_to_str(self._GetProcessNameOfCurrentSampleFunc(self.getInstance()))
 
@@ -675,12 +826,14 @@ class ReportLib(object):
         if not symbols:
             return None
 
-        i = 0
         result = []
-        while symbols[i]._symbol_name:
-            result.append((symbols[i].symbol_addr,
-                           symbols[i].symbol_len,
-                           symbols[i].symbol_name))
+        i = 0
+        while True:
+            # Index the array once per symbol, as each index creates a new struct view.
+            symbol = symbols[i]
+            if not symbol._symbol_name:
+                break
+            result.append((symbol.symbol_addr, symbol.symbol_len, symbol.symbol_name))
             i += 1
 
         return result
@@ -695,6 +848,51 @@ ProtoSymbol = namedtuple(
 ProtoMapping = namedtuple('ProtoMapping', ['start', 'end', 'pgoff'])
 ProtoCallChain = namedtuple('ProtoCallChain', ['nr', 'entries'])
 ProtoCallChainEntry = namedtuple('ProtoCallChainEntry', ['ip', 'symbol'])
+ProtoFileContent = namedtuple('ProtoFileContent', ['records', 'files', 'thread_map', 'meta_info'])
+
+
+def _parse_proto_file(record_file: str) -> ProtoFileContent:
+    """ Parse a profile in cmd_report_sample.proto format. """
+    with open(record_file, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size < 12:
+            # mmap can't map empty files, and such small files fail the header check anyway.
+            return _parse_proto_records(fh.read())
+        # Map the file instead of reading it, so only the record slices passed to the protobuf
+        # parser are copied.
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _parse_proto_records(data)
+
+
+def _parse_proto_records(data: Union[bytes, mmap.mmap]) -> ProtoFileContent:
+    report_sample_pb2 = ProtoFileReportLib.get_report_sample_pb2()
+    records = []
+    files = []
+    thread_map = {}
+    meta_info = None
+    _check(data[:10] == b'SIMPLEPERF', f'magic number mismatch: {data[:10]}')
+    version = struct.unpack_from('<H', data, 10)[0]
+    _check(version == 1, f'version mismatch: {version}')
+    i = 12
+    data_size = len(data)
+    while i < data_size:
+        _check(i + 4 <= data_size, 'data format error')
+        size = struct.unpack_from('<I', data, i)[0]
+        if size == 0:
+            break
+        i += 4
+        _check(i + size <= data_size, 'data format error')
+        record = report_sample_pb2.Record()
+        record.ParseFromString(data[i: i + size])
+        i += size
+        if record.HasField('sample') or record.HasField('context_switch'):
+            records.append(record)
+        elif record.HasField('file'):
+            files.append(record.file)
+        elif record.HasField('thread'):
+            thread_map[record.thread.thread_id] = record.thread
+        elif record.HasField('meta_info'):
+            meta_info = record.meta_info
+    return ProtoFileContent(records, files, thread_map, meta_info)
 
 
 class ProtoFileReportLib:
@@ -746,32 +944,13 @@ class ProtoFileReportLib:
 
     def SetRecordFile(self, record_file: str):
         self.record_file = record_file
-        with open(record_file, 'rb') as fh:
-            data = fh.read()
-        _check(data[:10] == b'SIMPLEPERF', f'magic number mismatch: {data[:10]}')
-        version = struct.unpack('<H', data[10:12])[0]
-        _check(version == 1, f'version mismatch: {version}')
-        i = 12
-        while i < len(data):
-            _check(i + 4 <= len(data), 'data format error')
-            size = struct.unpack('<I', data[i:i + 4])[0]
-            if size == 0:
-                break
-            i += 4
-            _check(i + size <= len(data), 'data format error')
-            record = self.report_sample_pb2.Record()
-            record.ParseFromString(data[i: i + size])
-            i += size
-            if record.HasField('sample') or record.HasField('context_switch'):
-                self.records.append(record)
-            elif record.HasField('file'):
-                self.files.append(record.file)
-            elif record.HasField('thread'):
-                self.thread_map[record.thread.thread_id] = record.thread
-            elif record.HasField('meta_info'):
-                self.meta_info = record.meta_info
-                if self.meta_info.trace_offcpu:
-                    self.trace_offcpu_mode = 'mixed-on-off-cpu'
+        content = _parse_proto_file(record_file)
+        self.records = content.records
+        self.files = content.files
+        self.thread_map = content.thread_map
+        self.meta_info = content.meta_info
+        if self.meta_info and self.meta_info.trace_offcpu:
+            self.trace_offcpu_mode = 'mixed-on-off-cpu'
         fake_mapping_start = 0
         for file in self.files:
             self.fake_mapping_starts.append(fake_mapping_start)
@@ -886,6 +1065,28 @@ class ProtoFileReportLib:
             ip=0, pid=thread.process_id, tid=thread.thread_id, thread_comm=thread.thread_name,
             time=sample.time, in_kernel=False, cpu=0, period=sample.event_count)
 
+    def GetNextSampleFull(self) -> Optional[FullSample]:
+        """ Return the next sample with its event, symbol and callchain. If no more samples,
+            return None.
+        """
+        sample = self.GetNextSample()
+        if sample is None:
+            return None
+        return FullSample(sample, self.GetEventOfCurrentSample(), self.GetSymbolOfCurrentSample(),
+                          self.GetCallChainOfCurrentSample())
+
+    def IterSamples(self, fields: Sequence[str]) -> Iterator[Tuple]:
+        """ Iterate over the remaining samples, yielding a tuple of the selected fields for each
+            sample. A field can be an attribute of ProtoSample or 'event_name'.
+        """
+        return IterSamplesForReportLib(self, fields)
+
+    def GetSampleColumns(self, fields: Sequence[str]) -> Dict[str, Union[array.array, List[str]]]:
+        """ Read the remaining samples, and return a map from each selected field to a column
+            of its values, one per sample.
+        """
+        return GetSampleColumnsForReportLib(self, fields)
+
     def GetEventOfCurrentSample(self) -> ProtoEvent:
         sample = self.sample_queue[0]
         event_type_id = 0 if self.trace_offcpu_mode == 'mixed-on-off-cpu' else sample.event_type_id
@@ -908,6 +1109,16 @@ class ProtoFileReportLib:
             entries.append(ProtoCallChainEntry(ip=0, symbol=symbol))
         return ProtoCallChain(nr=len(entries), entries=entries)
 
+    def GetCallChainDsoNamesOfCurrentSample(self) -> List[str]:
+        """ Return dso names of all callchain entries of the current sample. """
+        sample = self.sample_queue[0]
+        return [self.files[node.file_id].path for node in sample.callchain[1:]]
+
+    def GetCallChainSymbolNamesOfCurrentSample(self) -> List[str]:
+        """ Return symbol names of all callchain entries of the current sample. """
+        sample = self.sample_queue[0]
+        return [self._build_symbol(node).symbol_name for node in sample.callchain[1:]]
+
     def _build_symbol(self, node) -> ProtoSymbol:
         file = self.files[node.file_id]
         if node.symbol_id == -1:
@@ -23,6 +23,7 @@ import argparse
 from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 import etm_types as etm
+import functools
 import logging
 import os
 import os.path
@@ -1048,17 +1049,27 @@ class ReadElf(object):
     def get_build_id(self, elf_file_path: Union[Path, str], with_padding=True) -> str:
         """ Get build id of an elf file. """
         if self.is_elf_file(elf_file_path):
-            try:
-                output = subprocess.check_output([self.readelf_path, '-n', str(elf_file_path)])
-                output = bytes_to_str(output)
-                result = re.search(r'Build ID:\s*(\S+)', output)
-                if result:
-                    build_id = result.group(1)
-                    if with_padding:
-                        build_id = self.pad_build_id(build_id)
-                    return build_id
-            except subprocess.CalledProcessError:
-                pass
+            # Build ids are cached by file path and stat, because reading one runs readelf.
+            path = os.path.abspath(elf_file_path)
+            stat = os.stat(path)
+            build_id = self._read_build_id(self.readelf_path, path, stat.st_mtime_ns, stat.st_size)
+            if build_id:
+                if with_padding:
+                    build_id = self.pad_build_id(build_id)
+                return build_id
+        return ""
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _read_build_id(readelf_path: str, elf_file_path: str, mtime_ns: int, size: int) -> str:
+        try:
+            output = subprocess.check_output([readelf_path, '-n', elf_file_path])
+            output = bytes_to_str(output)
+            result = re.search(r'Build ID:\s*(\S+)', output)
+            if result:
+                return result.group(1)
+        except subprocess.CalledProcessError:
+            pass
         return ""
 
     @staticmethod
@@ -25,47 +25,51 @@ It includes below tests:
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 import fnmatch
-import inspect
+import functools
+import importlib
+import json
 import multiprocessing as mp
+import multiprocessing.forkserver
 import os
 from pathlib import Path
 import re
+import shutil
 import subprocess
 import sys
+import threading
 import time
 from tqdm import tqdm
 import types
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple, Union
 import unittest
 
-from simpleperf_utils import BaseArgumentParser, extant_dir, log_exit, remove, is_darwin
-
-from . api_profiler_test import *
-from . annotate_test import *
-from . app_profiler_test import *
-from . app_test import *
-from . binary_cache_builder_test import *
-from . cpp_app_test import *
-from . debug_unwind_reporter_test import *
-from . etm_stack_test import *
-from . gecko_profile_generator_test import *
-from . inferno_test import *
-from . java_app_test import *
-from . kotlin_app_test import *
-from . pprof_proto_generator_test import *
-from . purgatorio_test import *
-from . report_html_test import *
-from . report_lib_test import *
-from . report_sample_test import *
-from . run_simpleperf_on_device_test import *
-from . sample_filter_test import *
-from . stackcollapse_test import *
-from . tools_test import *
+from simpleperf_utils import (BaseArgumentParser, extant_dir, log_exit, remove, is_darwin,
+                              is_windows)
+
 from . test_utils import TestHelper
 
 
+def positive_int(arg: str) -> int:
+    """ArgumentParser type that only accepts integers greater than 0.
+
+    Args:
+        arg: The string argument given on the command line.
+    Returns: The argument as an int.
+    Raises:
+        argparse.ArgumentTypeError: The given argument isn't a positive integer.
+    """
+    try:
+        value = int(arg)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError('{} is not a positive integer.'.format(arg))
+    return value
+
+
 def get_args() -> argparse.Namespace:
     parser = BaseArgumentParser(description=__doc__)
     parser.add_argument('--browser', action='store_true', help='open report html file in browser.')
@@ -73,6 +77,8 @@ def get_args() -> argparse.Namespace:
         '-d', '--device', nargs='+',
         help='set devices used to run tests. Each device in format name:serial-number')
     parser.add_argument('--only-host-test', action='store_true', help='Only run host tests')
+    parser.add_argument('--host-test-jobs', type=positive_int,
+                        help='Number of processes to run host tests. Default is cpu count.')
     parser.add_argument('--list-tests', action='store_true', help='List tests')
     parser.add_argument('--ndk-path', type=extant_dir, help='Set the path of a ndk release')
     parser.add_argument('-p', '--pattern', nargs='+',
@@ -83,15 +89,118 @@ def get_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
+# Test modules are imported only when their testcases are needed, to reduce startup time.
+TEST_MODULES = [
+    'api_profiler_test',
+    'annotate_test',
+    'app_profiler_test',
+    'app_test',
+    'binary_cache_builder_test',
+    'cpp_app_test',
+    'debug_unwind_reporter_test',
+    'etm_stack_test',
+    'gecko_profile_generator_test',
+    'inferno_test',
+    'java_app_test',
+    'kotlin_app_test',
+    'pprof_proto_generator_test',
+    'purgatorio_test',
+    'report_html_test',
+    'report_lib_test',
+    'report_sample_test',
+    'run_simpleperf_on_device_test',
+    'sample_filter_test',
+    'stackcollapse_test',
+    'tools_test',
+]
+
+_ALL_TESTS: Optional[List[str]] = None
+# Map from testcase name to the name of the test module defining it.
+_TESTCASE_MODULES: Dict[str, str] = {}
+
+
+def import_test_modules(module_names: List[str]):
+    """ Import test modules, and add their testcases to this module, where unittest loads tests
+        from.
+    """
+    for module_name in module_names:
+        module = importlib.import_module('.' + module_name, __package__)
+        for name, value in vars(module).items():
+            if isinstance(value, type) and issubclass(value, unittest.TestCase):
+                globals()[name] = value
+                _TESTCASE_MODULES[name] = value.__module__.rsplit('.', 1)[-1]
+
+
+def get_test_modules(tests: List[str]) -> List[str]:
+    """ Return names of test modules needed to run tests. """
+    return sorted({_TESTCASE_MODULES[test.split('.')[0]] for test in tests})
+
+
+def get_test_methods(test_case: type) -> List[str]:
+    """ Return names of test methods defined in a TestCase class and its base classes. """
+    methods = set()
+    visited = set()
+    for cls in test_case.__mro__:
+        # Mixins can follow unittest.TestCase in the mro, so skip it instead of stopping there.
+        if cls is unittest.TestCase or cls is object:
+            continue
+        for member_name, member in vars(cls).items():
+            # A name defined in a subclass hides the same name in base classes.
+            if member_name.startswith('test') and member_name not in visited:
+                visited.add(member_name)
+                if isinstance(member, types.FunctionType):
+                    methods.add(member_name)
+    return list(methods)
+
+
+TEST_LIST_CACHE_PATH = Path.home() / '.cache' / 'simpleperf' / 'test_list.json'
+
+
+def get_test_module_mtimes() -> Dict[str, int]:
+    """ Return modification times of test modules, used to check if the test list cache is
+        valid.
+    """
+    script_test_dir = Path(__file__).resolve().parent
+    return {str(path): path.stat().st_mtime_ns for path in sorted(script_test_dir.glob('*.py'))}
+
+
+def load_test_list_cache(mtimes: Dict[str, int]) -> Optional[List[str]]:
+    try:
+        data = json.loads(TEST_LIST_CACHE_PATH.read_text())
+    except (OSError, ValueError):
+        return None
+    if (isinstance(data, dict) and data.get('mtimes') == mtimes and 'tests' in data and
+            'testcase_modules' in data):
+        _TESTCASE_MODULES.update(data['testcase_modules'])
+        return data['tests']
+    return None
+
+
+def save_test_list_cache(mtimes: Dict[str, int], tests: List[str]):
+    try:
+        TEST_LIST_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        TEST_LIST_CACHE_PATH.write_text(json.dumps(
+            {'mtimes': mtimes, 'tests': tests, 'testcase_modules': _TESTCASE_MODULES}))
+    except OSError:
+        # The cache is only an optimization.
+        pass
+
+
 def get_all_tests() -> List[str]:
-    tests = []
-    for name, value in globals().items():
-        if isinstance(value, type) and issubclass(value, unittest.TestCase):
-            for member_name, member in inspect.getmembers(value):
-                if isinstance(member, (types.MethodType, types.FunctionType)):
-                    if member_name.startswith('test'):
+    global _ALL_TESTS
+    if _ALL_TESTS is None:
+        mtimes = get_test_module_mtimes()
+        _ALL_TESTS = load_test_list_cache(mtimes)
+        if _ALL_TESTS is None:
+            import_test_modules(TEST_MODULES)
+            tests = []
+            for name, value in list(globals().items()):
+                if isinstance(value, type) and issubclass(value, unittest.TestCase):
+                    for member_name in get_test_methods(value):
                         tests.append(name + '.' + member_name)
-    return sorted(tests)
+            _ALL_TESTS = sorted(tests)
+            save_test_list_cache(mtimes, _ALL_TESTS)
+    return _ALL_TESTS[:]
 
 
 def get_host_tests() -> List[str]:
@@ -110,42 +219,77 @@ def get_filtered_tests(
         except ValueError:
             log_exit("Can't find test %s" % test_from)
     if test_pattern:
-        patterns = [re.compile(fnmatch.translate(x)) for x in test_pattern]
-        tests = [t for t in tests if any(pattern.match(t) for pattern in patterns)]
+        # Join all patterns into one regex, so each test is matched with a single call.
+        pattern = re.compile('|'.join('(?:%s)' % fnmatch.translate(x) for x in test_pattern))
+        tests = [t for t in tests if pattern.match(t)]
         if not tests:
             log_exit('No tests are matched.')
     return tests
 
 
+_TEST_TYPE_MAP: Dict[str, str] = {}
+_TEST_TYPE_MAP.update({name: 'device_test' for name in (
+    'TestApiProfiler',
+    'TestNativeProfiling',
+    'TestNativeLibDownloader',
+    'TestRecordingRealApps',
+    'TestRunSimpleperfOnDevice')})
+_TEST_TYPE_MAP.update({name: 'host_test' for name in (
+    'TestAnnotate',
+    'TestBinaryCacheBuilder',
+    'TestDebugUnwindReporter',
+    'TestEtmStacker',
+    'TestInferno',
+    'TestPprofProtoGenerator',
+    'TestProtoFileReportLib',
+    'TestPurgatorio',
+    'TestReportHtml',
+    'TestReportLib',
+    'TestReportSample',
+    'TestSampleFilter',
+    'TestStackCollapse',
+    'TestTools',
+    'TestGeckoProfileGenerator')})
+
+
+@functools.lru_cache(maxsize=None)
 def get_test_type(test: str) -> Optional[str]:
     testcase_name, test_name = test.split('.')
     if test_name == 'test_run_simpleperf_without_usb_connection':
         return 'device_serialized_test'
-    if testcase_name in (
-        'TestApiProfiler', 'TestNativeProfiling', 'TestNativeLibDownloader',
-            'TestRecordingRealApps', 'TestRunSimpleperfOnDevice'):
-        return 'device_test'
+    test_type = _TEST_TYPE_MAP.get(testcase_name)
+    if test_type:
+        return test_type
     if testcase_name.startswith('TestExample'):
         return 'device_test'
-    if testcase_name in ('TestAnnotate',
-                         'TestBinaryCacheBuilder',
-                         'TestDebugUnwindReporter',
-                         'TestEtmStacker',
-                         'TestInferno',
-                         'TestPprofProtoGenerator',
-                         'TestProtoFileReportLib',
-                         'TestPurgatorio',
-                         'TestReportHtml',
-                         'TestReportLib',
-                         'TestReportSample',
-                         'TestSampleFilter',
-                         'TestStackCollapse',
-                         'TestTools',
-                         'TestGeckoProfileGenerator'):
-        return 'host_test'
     return None
 
 
+def classify_tests(tests: List[str]) -> Tuple[List[str], List[str], List[str]]:
+    """ Split tests into (device_tests, device_serialized_tests, host_tests) in one pass. """
+    buckets: Dict[str, List[str]] = {
+        'device_test': [],
+        'device_serialized_test': [],
+        'host_test': [],
+    }
+    for test in tests:
+        bucket = buckets.get(get_test_type(test))
+        assert bucket is not None, f'No test type for test {test}'
+        bucket.append(test)
+    return buckets['device_test'], buckets['device_serialized_test'], buckets['host_test']
+
+
+def link_or_copy(src_path: Union[str, Path], dest_path: Union[str, Path]):
+    """ Hard link a file if possible, otherwise copy it. Tests only read testdata, so they
+        can share files with the source dirs.
+    """
+    try:
+        os.link(src_path, dest_path)
+    except OSError:
+        # Hard links aren't supported across file systems, or on some file systems.
+        shutil.copyfile(src_path, dest_path)
+
+
 def build_testdata(testdata_dir: Path):
     """ Collect testdata in testdata_dir.
         In system/extras/simpleperf/scripts, testdata comes from:
@@ -166,38 +310,56 @@ def build_testdata(testdata_dir: Path):
         script_dir.parent / 'runtest',
     ]
 
+    # Collect paths first. When the same name appears in multiple source dirs, the first wins.
+    copy_paths: Dict[str, Tuple[Path, Path]] = {}
     for source_dir in source_dirs:
         if not source_dir.is_dir():
             continue
         for src_path in source_dir.iterdir():
-            dest_path = testdata_dir / src_path.name
-            if dest_path.exists():
-                continue
-            if src_path.is_file():
-                shutil.copyfile(src_path, dest_path)
-            elif src_path.is_dir():
-                shutil.copytree(src_path, dest_path)
+            if src_path.name not in copy_paths and (src_path.is_file() or src_path.is_dir()):
+                copy_paths[src_path.name] = (src_path, testdata_dir / src_path.name)
+
+    def copy_path(src_path: Path, dest_path: Path):
+        if src_path.is_file():
+            link_or_copy(src_path, dest_path)
+        else:
+            shutil.copytree(src_path, dest_path, copy_function=link_or_copy)
+
+    # Copying is I/O bound, so threads can run it in parallel.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(copy_path, src_path, dest_path)
+                   for src_path, dest_path in copy_paths.values()]
+        for future in futures:
+            # Raise exceptions from the worker threads.
+            future.result()
 
 
 def run_tests(tests: List[str]) -> bool:
-    argv = [sys.argv[0]] + tests
+    # Only load selected tests, instead of running the unittest command line program.
+    loader = unittest.TestLoader()
+    module = sys.modules[__name__]
+    suite = unittest.TestSuite(loader.loadTestsFromName(test, module) for test in tests)
     test_runner = unittest.TextTestRunner(stream=TestHelper.log_fh, verbosity=0)
-    test_program = unittest.main(argv=argv, testRunner=test_runner,
-                                 exit=False, verbosity=0, module='test.do_test')
-    return test_program.result.wasSuccessful()
+    return test_runner.run(suite).wasSuccessful()
 
 
-def test_process_entry(tests: List[str], test_options: List[str], conn: mp.connection.Connection):
+def test_process_entry(
+        tests: List[str],
+        test_modules: List[str],
+        test_options: List[str],
+        conn: mp.connection.Connection):
     parser = argparse.ArgumentParser()
     parser.add_argument('--browser', action='store_true')
     parser.add_argument('--device', help='android device serial number')
     parser.add_argument('--ndk-path', type=extant_dir)
     parser.add_argument('--testdata-dir', type=extant_dir)
     parser.add_argument('--test-dir', help='directory to store test results')
+    parser.add_argument('--results-file', help='file to append test results')
     args = parser.parse_args(test_options)
 
     TestHelper.init(args.test_dir, args.testdata_dir,
-                    args.browser, args.ndk_path, args.device, conn)
+                    args.browser, args.ndk_path, args.device, conn, args.results_file)
+    import_test_modules(test_modules)
     run_tests(tests)
 
 
@@ -225,23 +387,36 @@ class TestProcess:
     """ Create a test process to run selected tests on a device. """
 
     TEST_MAX_TRY_TIME = 10
+    # Max consecutive tries a test process can stop at the same unfinished test.
+    TEST_MAX_CONSECUTIVE_FAILURES = 2
     TEST_TIMEOUT_IN_SEC = 10 * 60
 
     def __init__(
             self, test_type: str, tests: List[str],
             device: Optional[Device],
             repeat_index: int,
-            test_options: List[str]):
+            test_options: List[str],
+            base_dir: Path,
+            shard_index: Optional[int] = None):
         self.test_type = test_type
         self.tests = tests
         self.device = device
         self.repeat_index = repeat_index
         self.test_options = test_options
+        self.base_dir = base_dir
+        self.shard_index = shard_index
+        self.name = self._get_name()
         self.try_time = 1
+        # Directory to run the tests. It changes with try_time.
+        self.test_dir = self._get_test_dir()
         self.test_results: Dict[str, TestResult] = {}
         self.parent_conn: Optional[mp.connection.Connection] = None
         self.proc: Optional[mp.Process] = None
         self.last_update_time = 0.0
+        # The first unfinished test when the last try stopped, and how many consecutive tries
+        # stopped at it.
+        self._last_unfinished_test: Optional[str] = None
+        self._consecutive_failures = 0
         self._start_test_process()
 
     def _start_test_process(self):
@@ -252,22 +427,28 @@ class TestProcess:
         if self.device:
             test_options += ['--device', self.device.serial_number]
         self.proc = mp.Process(target=test_process_entry, args=(
-            unfinished_tests, test_options, child_conn))
+            unfinished_tests, get_test_modules(unfinished_tests), test_options, child_conn))
         self.proc.start()
+        # Close the parent's copy of the write end, so the pipe reports EOF once the child exits.
+        child_conn.close()
         self.last_update_time = time.time()
 
-    @property
-    def name(self) -> str:
+    def _get_name(self) -> str:
         name = self.test_type
         if self.device:
             name += '_' + self.device.name
+        if self.shard_index is not None:
+            name += '_shard_%d' % self.shard_index
         name += '_repeat_%d' % self.repeat_index
         return name
 
+    def _get_test_dir(self) -> Path:
+        return self.base_dir / (self.name + '_try_%d' % self.try_time)
+
     @property
-    def test_dir(self) -> Path:
-        """ Directory to run the tests. """
-        return Path.cwd() / (self.name + '_try_%d' % self.try_time)
+    def wait_objects(self) -> List[Any]:
+        """ Objects becoming ready when the test process sends a message or exits. """
+        return [self.parent_conn, self.proc.sentinel]
 
     @property
     def alive(self) -> bool:
@@ -279,10 +460,12 @@ class TestProcess:
         """ Return if all tests are finished. """
         return len(self.test_results) == len(self.tests)
 
-    def check_update(self):
-        """ Check if there is any test update. """
+    def check_update(self, has_msg: bool = True):
+        """ Check if there is any test update. When has_msg is False, the pipe is known to be
+            empty, and only the timeout is checked.
+        """
         try:
-            while self.parent_conn.poll():
+            while has_msg and self.parent_conn.poll():
                 msg = self.parent_conn.recv()
                 self._process_msg(msg)
                 self.last_update_time = time.time()
@@ -291,15 +474,19 @@ class TestProcess:
         if time.time() - self.last_update_time > TestProcess.TEST_TIMEOUT_IN_SEC:
             self.proc.terminate()
 
-    def _process_msg(self, msg: str):
-        test_name, test_success, test_duration = msg.split()
-        self.test_results[test_name] = TestResult(self.try_time, test_success, test_duration)
+    def _process_msg(self, msg: Tuple[str, str, float]):
+        test_name, test_status, test_duration = msg
+        self.test_results[test_name] = TestResult(
+            self.try_time, test_status, '%.3fs' % test_duration)
 
     def join(self):
         self.proc.join()
 
     def restart(self) -> bool:
         """ Create a new test process to run unfinished tests. """
+        if self.finished:
+            return False
+        self._check_deterministic_failure()
         if self.finished:
             return False
         if self.try_time == self.TEST_MAX_TRY_TIME:
@@ -311,22 +498,49 @@ class TestProcess:
             return False
 
         self.try_time += 1
+        self.test_dir = self._get_test_dir()
         self._start_test_process()
         return True
 
+    def _check_deterministic_failure(self):
+        """ Tests run in order, so the first unfinished test is the one that crashed or hung the
+            test process. If it stops several tries in a row, retrying it again is unlikely to
+            help. So mark it as failed and go on with the tests after it.
+        """
+        test = next(test for test in self.tests if test not in self.test_results)
+        if test == self._last_unfinished_test:
+            self._consecutive_failures += 1
+        else:
+            self._last_unfinished_test = test
+            self._consecutive_failures = 1
+        if self._consecutive_failures >= self.TEST_MAX_CONSECUTIVE_FAILURES:
+            test_duration = '%.3fs' % (time.time() - self.last_update_time)
+            self.test_results[test] = TestResult(self.try_time, 'FAILED', test_duration)
+
 
 class ProgressBar:
     def __init__(self, total_count: int):
+        # Query the terminal width once for all bars, and limit the refresh rate. So fast tests
+        # don't spend time on redrawing bars.
+        self.bar_options = {
+            'ascii': ' ##',
+            'mininterval': 0.2,
+            'miniters': 1,
+            'dynamic_ncols': False,
+            'ncols': shutil.get_terminal_size().columns,
+        }
         self.total_bar = tqdm(
-            total=total_count, desc='test progress', ascii=' ##',
-            bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}, {rate_fmt}", position=0)
+            total=total_count, desc='test progress',
+            bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}, {rate_fmt}", position=0,
+            **self.bar_options)
         self.test_process_bars: Dict[str, tqdm] = {}
 
     def update(self, test_proc: TestProcess):
         if test_proc.name not in self.test_process_bars:
             bar = tqdm(total=len(test_proc.tests),
-                       desc=test_proc.name, ascii=' ##',
-                       bar_format="{l_bar}{bar} | {n_fmt}/{total_fmt} [{elapsed}]")
+                       desc=test_proc.name,
+                       bar_format="{l_bar}{bar} | {n_fmt}/{total_fmt} [{elapsed}]",
+                       **self.bar_options)
             self.test_process_bars[test_proc.name] = bar
         else:
             bar = self.test_process_bars[test_proc.name]
@@ -348,6 +562,9 @@ class ProgressBar:
 
 
 class TestSummary:
+    # Minimum interval between two writes of summary files in the writer thread.
+    WRITE_INTERVAL_IN_SEC = 0.25
+
     def __init__(
             self, devices: List[Device],
             device_tests: List[str],
@@ -359,7 +576,15 @@ class TestSummary:
                     self.results[(test, '%s_repeat_%d' % (device.name, repeat_index))] = None
         for test in host_tests:
             self.results[(test, 'host')] = None
+        # Keys don't change after init, so sort them only once.
+        self._sorted_keys = sorted(self.results.keys())
         self.write_summary()
+        # Summary files are updated in a writer thread, so the monitor loop doesn't wait for
+        # file writes.
+        self._updated = threading.Event()
+        self._closed = False
+        self._writer_thread = threading.Thread(target=self._summary_writer_loop, daemon=True)
+        self._writer_thread.start()
 
     @property
     def test_count(self) -> int:
@@ -378,32 +603,55 @@ class TestSummary:
             test_env = '%s_repeat_%d' % (test_proc.device.name, test_proc.repeat_index)
         else:
             test_env = 'host'
-        has_update = False
         for test, result in test_proc.test_results.items():
             key = (test, test_env)
             if self.results[key] != result:
                 self.results[key] = result
-                has_update = True
-        if has_update:
+                self._updated.set()
+
+    def _summary_writer_loop(self):
+        while True:
+            self._updated.wait()
+            if self._closed:
+                break
+            self._updated.clear()
             self.write_summary()
+            # Merge updates in the interval into one write.
+            time.sleep(self.WRITE_INTERVAL_IN_SEC)
+
+    def close(self):
+        """ Stop the writer thread, and write final summary files. """
+        self._closed = True
+        self._updated.set()
+        self._writer_thread.join()
+        self.write_summary()
 
     def write_summary(self):
-        with open('test_summary.txt', 'w') as fh, \
-                open('failed_test_summary.txt', 'w') as failed_fh:
-            for key in sorted(self.results.keys()):
-                test_name, test_env = key
-                result = self.results[key]
-                message = f'{test_name}    {test_env}    {result}'
-                print(message, file=fh)
-                if not result or result.status == 'FAILED':
-                    print(message, file=failed_fh)
+        lines = []
+        failed_lines = []
+        for key in self._sorted_keys:
+            test_name, test_env = key
+            result = self.results[key]
+            message = f'{test_name}    {test_env}    {result}\n'
+            lines.append(message)
+            if not result or result.status == 'FAILED':
+                failed_lines.append(message)
+        with open('test_summary.txt', 'w') as fh:
+            fh.write(''.join(lines))
+        with open('failed_test_summary.txt', 'w') as fh:
+            fh.write(''.join(failed_lines))
 
 
 class TestManager:
     """ Create test processes, monitor their status and log test progresses. """
 
+    WAIT_TIMEOUT_IN_SEC = 1.0
+
     def __init__(self, args: argparse.Namespace):
         self.repeat_count = args.repeat
+        # Test processes run in sub dirs of the current dir.
+        self.base_dir = Path.cwd()
+        self.host_test_jobs = args.host_test_jobs or os.cpu_count() or 1
         self.test_options = self._build_test_options(args)
         self.devices = self._build_test_devices(args)
         self.progress_bar: Optional[ProgressBar] = None
@@ -427,21 +675,12 @@ class TestManager:
             test_options += ['--ndk-path', args.ndk_path]
         testdata_dir = Path('testdata').resolve()
         test_options += ['--testdata-dir', str(testdata_dir)]
+        # Test processes append results to the same file, which can be used to watch progress.
+        test_options += ['--results-file', str(Path('results.jsonl').resolve())]
         return test_options
 
     def run_all_tests(self, tests: List[str]):
-        device_tests = []
-        device_serialized_tests = []
-        host_tests = []
-        for test in tests:
-            test_type = get_test_type(test)
-            assert test_type, f'No test type for test {test}'
-            if test_type == 'device_test':
-                device_tests.append(test)
-            if test_type == 'device_serialized_test':
-                device_serialized_tests.append(test)
-            if test_type == 'host_test':
-                host_tests.append(test)
+        device_tests, device_serialized_tests, host_tests = classify_tests(tests)
         total_test_count = (len(device_tests) + len(device_serialized_tests)
                             ) * len(self.devices) * self.repeat_count + len(host_tests)
         self.progress_bar = ProgressBar(total_test_count)
@@ -460,29 +699,49 @@ class TestManager:
         """ Tests can run in parallel on different devices. """
         test_procs: List[TestProcess] = []
         for device in self.devices:
-            test_procs.append(TestProcess('device_test', tests, device, 1, self.test_options))
+            test_procs.append(TestProcess('device_test', tests, device, 1,
+                                          self.test_options, self.base_dir))
         self.wait_for_test_results(test_procs, self.repeat_count)
 
     def run_device_serialized_tests(self, tests: List[str]):
         """ Tests run on each device in order. """
         for device in self.devices:
-            test_proc = TestProcess('device_serialized_test', tests, device, 1, self.test_options)
+            test_proc = TestProcess('device_serialized_test', tests, device, 1,
+                                    self.test_options, self.base_dir)
             self.wait_for_test_results([test_proc], self.repeat_count)
 
     def run_host_tests(self, tests: List[str]):
-        """ Tests run only once on host. """
-        test_proc = TestProcess('host_tests', tests, None, 1, self.test_options)
-        self.wait_for_test_results([test_proc], 1)
+        """ Tests run only once on host. They are independent, so split them into shards running
+            in parallel.
+        """
+        shard_count = min(self.host_test_jobs, len(tests))
+        if shard_count == 1:
+            test_procs = [TestProcess('host_tests', tests, None, 1, self.test_options,
+                                      self.base_dir)]
+        else:
+            # Interleave tests, so slow tests of the same testcase are spread over shards.
+            test_procs = [TestProcess('host_tests', tests[i::shard_count], None, 1,
+                                      self.test_options, self.base_dir, shard_index=i + 1)
+                          for i in range(shard_count)]
+        self.wait_for_test_results(test_procs, 1)
 
     def wait_for_test_results(self, test_procs: List[TestProcess], repeat_count: int):
         test_count = sum(len(test_proc.tests) for test_proc in test_procs)
         while test_procs:
+            # Block until a test process sends a message or exits. Use a timeout to check for
+            # test processes that stop responding.
+            wait_objects = []
+            for test_proc in test_procs:
+                wait_objects += test_proc.wait_objects
+            ready_objects = mp.connection.wait(wait_objects, timeout=self.WAIT_TIMEOUT_IN_SEC)
             dead_procs: List[TestProcess] = []
-            # Check update.
+            # Check update. Only read pipes having messages, and all messages in a pipe are read
+            # in one batch. Always read pipes of dead procs, to not miss their last messages.
             for test_proc in test_procs:
-                if not test_proc.alive:
+                alive = test_proc.alive
+                if not alive:
                     dead_procs.append(test_proc)
-                test_proc.check_update()
+                test_proc.check_update(not alive or test_proc.parent_conn in ready_objects)
                 self.progress_bar.update(test_proc)
                 self.test_summary.update(test_proc)
 
@@ -500,16 +759,33 @@ class TestManager:
                 if test_proc.repeat_index < repeat_count:
                     test_procs.append(
                         TestProcess(test_proc.test_type, test_proc.tests, test_proc.device,
-                                    test_proc.repeat_index + 1, test_proc.test_options))
-            time.sleep(0.1)
+                                    test_proc.repeat_index + 1, test_proc.test_options,
+                                    test_proc.base_dir, test_proc.shard_index))
         return True
 
 
+def init_multiprocessing(test_modules: List[str]):
+    """ Select how to start test processes. It should be called before changing the current
+        directory, because the fork server imports the main module using a relative path.
+        test_modules are the test modules needed by the tests to run.
+    """
+    if is_windows():
+        mp.set_start_method('spawn')
+        return
+    # Like spawn, each test process starts from a clean state instead of a copy of this process.
+    # But the fork server imports needed test modules only once, instead of once in each test
+    # process. The main module is preloaded first to set up sys.path.
+    mp.set_start_method('forkserver')
+    mp.set_forkserver_preload(['__main__', __name__] +
+                              [__package__ + '.' + name for name in test_modules])
+    multiprocessing.forkserver.ensure_running()
+
+
 def run_tests_in_child_process(tests: List[str], args: argparse.Namespace) -> bool:
     """ run tests in child processes, read test results through a pipe. """
-    mp.set_start_method('spawn')  # to be consistent on darwin, linux, windows
     test_manager = TestManager(args)
     test_manager.run_all_tests(tests)
+    test_manager.test_summary.close()
 
     total_test_count = test_manager.test_summary.test_count
     failed_test_count = test_manager.test_summary.failed_test_count
@@ -530,6 +806,7 @@ def main() -> bool:
         print('\n'.join(tests))
         return True
 
+    init_multiprocessing(get_test_modules(tests))
     test_dir = Path(args.test_dir).resolve()
     remove(test_dir)
     test_dir.mkdir(parents=True)
@@ -14,19 +14,70 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import os
 from pathlib import Path
+import re
 import shutil
 import subprocess
+import sys
 import tempfile
-from typing import Dict, List, Optional, Set
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 from simpleperf_report_lib import ReportLib, ProtoFileReportLib
-from simpleperf_utils import get_host_binary_path, ReadElf
+from simpleperf_utils import get_host_binary_path, ReadElf, ReportLibOptions
 from . test_utils import TestBase, TestHelper
 
 
-class TestReportLib(TestBase):
+def get_event_stats(report_lib: Union[ReportLib, ProtoFileReportLib]) -> Dict[str, Tuple[int, int]]:
+    """ Return a map from event name to (sample count, total period) of the remaining samples. """
+    sample_counts: Dict[str, int] = {}
+    periods: Dict[str, int] = {}
+    for event_name, period in report_lib.IterSamples(['event_name', 'period']):
+        sample_counts[event_name] = sample_counts.get(event_name, 0) + 1
+        periods[event_name] = periods.get(event_name, 0) + period
+    return {name: (count, periods[name]) for name, count in sample_counts.items()}
+
+
+def start_profiling() -> bool:
+    """ When PROFILE_TESTS=1, write Python functions to /tmp/perf-<pid>.map, so `perf record`
+        on the test process can tell time in Python code from time in libsimpleperf_report.so.
+        It needs python >= 3.12. Return whether profiling is started.
+    """
+    if os.environ.get('PROFILE_TESTS') != '1':
+        return False
+    if not hasattr(sys, 'activate_stack_trampoline'):
+        TestHelper.log('PROFILE_TESTS=1 is ignored: perf map support needs python >= 3.12')
+        return False
+    try:
+        sys.activate_stack_trampoline('perf')
+    except ValueError as e:
+        # Python builds without perf trampoline support raise ValueError.
+        TestHelper.log(f'PROFILE_TESTS=1 is ignored: {e}')
+        return False
+    return True
+
+
+def stop_profiling(started: bool):
+    if started:
+        sys.deactivate_stack_trampoline()
+
+
+class ProfilingMixin:
+    """ Profile tests of a testcase when PROFILE_TESTS=1. Put it before TestBase in base classes.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.profiling = start_profiling()
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_profiling(cls.profiling)
+        super().tearDownClass()
+
+
+class TestReportLib(ProfilingMixin, TestBase):
     def setUp(self):
         super(TestReportLib, self).setUp()
         self.report_lib = ReportLib()
@@ -69,6 +120,34 @@ class TestReportLib(TestBase):
                 self.assertEqual(callchain.nr, 0)
         self.assertTrue(found_sample)
 
+    def test_iter_samples(self):
+        record_file = TestHelper.testdata_path('perf_with_symbols.data')
+        self.report_lib.SetRecordFile(record_file)
+        expected = []
+        while self.report_lib.GetNextSample():
+            sample = self.report_lib.GetCurrentSample()
+            event = self.report_lib.GetEventOfCurrentSample()
+            expected.append((sample.tid, sample.thread_comm, sample.period, event.name))
+        self.report_lib.Close()
+        self.report_lib = ReportLib()
+        self.report_lib.SetRecordFile(record_file)
+        samples = list(self.report_lib.IterSamples(['tid', 'thread_comm', 'period', 'event_name']))
+        self.assertEqual(samples, expected)
+        with self.assertRaises(ValueError):
+            list(self.report_lib.IterSamples(['unknown_field']))
+
+    def test_get_sample_columns(self):
+        record_file = TestHelper.testdata_path('perf_with_trace_offcpu_v2.data')
+        self.report_lib.SetRecordFile(record_file)
+        samples = list(self.report_lib.IterSamples(['tid', 'period', 'event_name']))
+        self.report_lib.Close()
+        self.report_lib = ReportLib()
+        self.report_lib.SetRecordFile(record_file)
+        columns = self.report_lib.GetSampleColumns(['tid', 'period', 'event_name'])
+        self.assertEqual(list(zip(columns['tid'], columns['period'], columns['event_name'])),
+                         samples)
+        self.assertEqual(sum(columns['period']), 396124304)
+
     def test_meta_info(self):
         self.report_lib.SetRecordFile(TestHelper.testdata_path('perf_with_trace_offcpu_v2.data'))
         meta_info = self.report_lib.MetaInfo()
@@ -103,12 +182,14 @@ class TestReportLib(TestBase):
         while self.report_lib.GetNextSample():
             sample = self.report_lib.GetCurrentSample()
             total_period += sample.period
+            # Only fetch the callchain when the sample isn't in the sleep function itself.
             if self.report_lib.GetSymbolOfCurrentSample().symbol_name == sleep_function_name:
                 sleep_function_period += sample.period
                 continue
             callchain = self.report_lib.GetCallChainOfCurrentSample()
+            entries = callchain.entries
             for i in range(callchain.nr):
-                if callchain.entries[i].symbol.symbol_name == sleep_function_name:
+                if entries[i].symbol.symbol_name == sleep_function_name:
                     sleep_function_period += sample.period
                     break
             self.assertEqual(self.report_lib.GetEventOfCurrentSample().name, 'cpu-clock:u')
@@ -119,7 +200,7 @@ class TestReportLib(TestBase):
         def has_art_frame(report_lib):
             report_lib.SetRecordFile(TestHelper.testdata_path('perf_with_interpreter_frames.data'))
             result = False
-            while report_lib.GetNextSample():
+            while not result and report_lib.GetNextSample():
                 callchain = report_lib.GetCallChainOfCurrentSample()
                 for i in range(callchain.nr):
                     if callchain.entries[i].symbol.symbol_name == 'artMterpAsmInstructionStart':
@@ -141,14 +222,9 @@ class TestReportLib(TestBase):
         def get_methods(report_lib) -> Set[str]:
             methods = set()
             report_lib.SetRecordFile(TestHelper.testdata_path('perf_display_bitmaps.data'))
-            while True:
-                sample = report_lib.GetNextSample()
-                if not sample:
-                    break
+            while report_lib.GetNextSample():
                 methods.add(report_lib.GetSymbolOfCurrentSample().symbol_name)
-                callchain = report_lib.GetCallChainOfCurrentSample()
-                for i in range(callchain.nr):
-                    methods.add(callchain.entries[i].symbol.symbol_name)
+                methods.update(report_lib.GetCallChainSymbolNamesOfCurrentSample())
             report_lib.Close()
             return methods
 
@@ -158,15 +234,37 @@ class TestReportLib(TestBase):
         self.assertFalse(any('android.view' in method for method in methods))
         self.assertTrue(any('android.widget' in method for method in methods))
 
+        # Removed methods in report options are merged into one regex.
+        report_lib = ReportLib()
+        report_lib.SetReportOptions(ReportLibOptions(
+            False, ['android.view', 'android.widget'], '', None, None, None))
+        methods = get_methods(report_lib)
+        self.assertFalse(any('android.view' in method for method in methods))
+        self.assertFalse(any('android.widget' in method for method in methods))
+
+        # Regexes with groups are added separately.
+        report_lib = ReportLib()
+        report_lib.SetReportOptions(ReportLibOptions(
+            False, ['android.widget', r'(android)\.view'], '', None, None, None))
+        methods = get_methods(report_lib)
+        self.assertFalse(any('android.view' in method for method in methods))
+        self.assertFalse(any('android.widget' in method for method in methods))
+
+        # An invalid regex is reported by itself, whether or not it can be merged.
+        for invalid_regex in ['(android.view', '(?<=android)view']:
+            report_lib = ReportLib()
+            with self.assertRaisesRegex(RuntimeError, re.escape(f'({invalid_regex})')):
+                report_lib.SetReportOptions(ReportLibOptions(
+                    False, ['android.widget', invalid_regex], '', None, None, None))
+            report_lib.Close()
+
     def test_merge_java_methods(self):
         def parse_dso_names(report_lib):
             dso_names = set()
             report_lib.SetRecordFile(TestHelper.testdata_path('perf_with_interpreter_frames.data'))
             while report_lib.GetNextSample():
                 dso_names.add(report_lib.GetSymbolOfCurrentSample().dso_name)
-                callchain = report_lib.GetCallChainOfCurrentSample()
-                for i in range(callchain.nr):
-                    dso_names.add(callchain.entries[i].symbol.dso_name)
+                dso_names.update(report_lib.GetCallChainDsoNamesOfCurrentSample())
             report_lib.Close()
             has_jit_symfiles = any('TemporaryFile-' in name for name in dso_names)
             has_jit_cache = '[JIT cache]' in dso_names
@@ -187,10 +285,10 @@ class TestReportLib(TestBase):
         report_lib = ReportLib()
         report_lib.SetRecordFile(TestHelper.testdata_path('perf_with_jit_symbol.data'))
         has_jit_cache = False
-        while report_lib.GetNextSample():
-            if report_lib.GetSymbolOfCurrentSample().dso_name == '[JIT app cache]':
+        while sample := report_lib.GetNextSampleFull():
+            if sample.symbol.dso_name == '[JIT app cache]':
                 has_jit_cache = True
-            callchain = report_lib.GetCallChainOfCurrentSample()
+            callchain = sample.callchain
             for i in range(callchain.nr):
                 if callchain.entries[i].symbol.dso_name == '[JIT app cache]':
                     has_jit_cache = True
@@ -213,6 +311,21 @@ class TestReportLib(TestBase):
                 self.assertIsNone(tracing_data)
         self.assertTrue(has_tracing_data)
 
+    def test_tracing_field(self):
+        self.report_lib.SetRecordFile(TestHelper.testdata_path('perf_with_tracepoint_event.data'))
+        has_tracing_data = False
+        while self.report_lib.GetNextSample():
+            tracing_data = self.report_lib.GetTracingDataOfCurrentSample()
+            if tracing_data is None:
+                self.assertIsNone(self.report_lib.GetTracingFieldOfCurrentSample('prev_pid'))
+                continue
+            has_tracing_data = True
+            for name, value in tracing_data.items():
+                self.assertEqual(self.report_lib.GetTracingFieldOfCurrentSample(name), value)
+            with self.assertRaises(KeyError):
+                self.report_lib.GetTracingFieldOfCurrentSample('non_exist_field')
+        self.assertTrue(has_tracing_data)
+
     def test_dynamic_field_in_tracing_data(self):
         self.report_lib.SetRecordFile(TestHelper.testdata_path(
             'perf_with_tracepoint_event_dynamic_field.data'))
@@ -271,24 +384,10 @@ class TestReportLib(TestBase):
                 TestHelper.testdata_path('perf_with_trace_offcpu_v2.data'))
             self.report_lib.SetTraceOffCpuMode(mode)
 
-            cpu_clock_period = 0
-            cpu_clock_samples = 0
-            sched_switch_period = 0
-            sched_switch_samples = 0
-            while self.report_lib.GetNextSample():
-                sample = self.report_lib.GetCurrentSample()
-                event = self.report_lib.GetEventOfCurrentSample()
-                if event.name == 'cpu-clock:u':
-                    cpu_clock_period += sample.period
-                    cpu_clock_samples += 1
-                else:
-                    self.assertEqual(event.name, 'sched:sched_switch')
-                    sched_switch_period += sample.period
-                    sched_switch_samples += 1
-            self.assertEqual(cpu_clock_samples, expected_values['cpu-clock:u'][0])
-            self.assertEqual(cpu_clock_period, expected_values['cpu-clock:u'][1])
-            self.assertEqual(sched_switch_samples, expected_values['sched:sched_switch'][0])
-            self.assertEqual(sched_switch_period, expected_values['sched:sched_switch'][1])
+            event_stats = get_event_stats(self.report_lib)
+            self.assertLessEqual(set(event_stats), set(expected_values))
+            for event_name, expected_value in expected_values.items():
+                self.assertEqual(event_stats.get(event_name, (0, 0)), expected_value)
 
         # Check trace-offcpu modes on a profile not recorded with --trace-offcpu.
         self.report_lib.Close()
@@ -305,11 +404,7 @@ class TestReportLib(TestBase):
             self.report_lib = ReportLib()
             self.report_lib.SetRecordFile(TestHelper.testdata_path('perf_display_bitmaps.data'))
             self.report_lib.SetSampleFilter(filters)
-            threads = set()
-            while self.report_lib.GetNextSample():
-                sample = self.report_lib.GetCurrentSample()
-                threads.add(sample.tid)
-            return threads
+            return set(self.report_lib.GetSampleColumns(['tid'])['tid'])
 
         self.assertNotIn(31850, get_threads_for_filter(['--exclude-pid', '31850']))
         self.assertIn(31850, get_threads_for_filter(['--include-pid', '31850']))
@@ -329,13 +424,15 @@ class TestReportLib(TestBase):
             ['--exclude-thread-name', 'Jit thread pool']))
         self.assertIn(31856, get_threads_for_filter(['--include-thread-name', 'Jit thread pool']))
 
-        with tempfile.NamedTemporaryFile('w', delete=False) as filter_file:
-            filter_file.write('GLOBAL_BEGIN 684943449406175\nGLOBAL_END 684943449406176')
-            filter_file.flush()
-            threads = get_threads_for_filter(['--filter-file', filter_file.name])
+        # Keep the filter file in memory when possible. It is written in a temporary directory,
+        # because the native lib can't open a NamedTemporaryFile still open on windows.
+        tmp_root = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        with tempfile.TemporaryDirectory(dir=tmp_root) as tmp_dir:
+            filter_file = Path(tmp_dir) / 'filter_file'
+            filter_file.write_text('GLOBAL_BEGIN 684943449406175\nGLOBAL_END 684943449406176')
+            threads = get_threads_for_filter(['--filter-file', str(filter_file)])
             self.assertIn(31881, threads)
             self.assertNotIn(31850, threads)
-        os.unlink(filter_file.name)
 
     def test_set_sample_filter_for_cpu(self):
         """ Test --cpu in ReportLib.SetSampleFilter(). """
@@ -344,11 +441,7 @@ class TestReportLib(TestBase):
             self.report_lib = ReportLib()
             self.report_lib.SetRecordFile(TestHelper.testdata_path('perf_display_bitmaps.data'))
             self.report_lib.SetSampleFilter(filters)
-            cpus = set()
-            while self.report_lib.GetNextSample():
-                sample = self.report_lib.GetCurrentSample()
-                cpus.add(sample.cpu)
-            return cpus
+            return set(self.report_lib.GetSampleColumns(['cpu'])['cpu'])
 
         cpus = get_cpus_for_filter(['--cpu', '0,1-2'])
         self.assertIn(0, cpus)
@@ -364,11 +457,8 @@ class TestReportLib(TestBase):
             self.report_lib.SetRecordFile(TestHelper.testdata_path('perf_display_bitmaps.data'))
             if aggregate_regex_list:
                 self.report_lib.AggregateThreads(aggregate_regex_list)
-            thread_names = {}
-            while self.report_lib.GetNextSample():
-                sample = self.report_lib.GetCurrentSample()
-                thread_names[sample.thread_comm] = thread_names.get(sample.thread_comm, 0) + 1
-            return thread_names
+            return collections.Counter(
+                self.report_lib.GetSampleColumns(['thread_comm'])['thread_comm'])
         thread_names = get_thread_names(None)
         self.assertEqual(thread_names['AsyncTask #3'], 6)
         self.assertEqual(thread_names['AsyncTask #4'], 13)
@@ -380,25 +470,36 @@ class TestReportLib(TestBase):
     def test_use_vmlinux(self):
         """ Test if we can use vmlinux in symfs_dir. """
         record_file = TestHelper.testdata_path('perf_test_vmlinux.data')
-        # Create a symfs_dir.
-        symfs_dir = Path('symfs_dir')
-        symfs_dir.mkdir()
-        shutil.copy(TestHelper.testdata_path('vmlinux'), symfs_dir)
-        kernel_build_id = ReadElf(TestHelper.ndk_path).get_build_id(symfs_dir / 'vmlinux')
-        (symfs_dir / 'build_id_list').write_text('%s=vmlinux' % kernel_build_id)
-
-        # Check if vmlinux in symfs_dir is used, when we set record file before setting symfs_dir.
-        self.report_lib.SetRecordFile(record_file)
-        self.report_lib.SetSymfs(str(symfs_dir))
-        sample = self.report_lib.GetNextSample()
-        self.assertIsNotNone(sample)
-        symbol = self.report_lib.GetSymbolOfCurrentSample()
-        self.assertEqual(symbol.dso_name, "[kernel.kallsyms]")
-        # vaddr_in_file and symbol_addr are adjusted after using vmlinux.
-        self.assertEqual(symbol.vaddr_in_file, 0xffffffc008fb3e28)
-        self.assertEqual(symbol.symbol_name, "_raw_spin_unlock_irq")
-        self.assertEqual(symbol.symbol_addr, 0xffffffc008fb3e0c)
-        self.assertEqual(symbol.symbol_len, 0x4c)
+        with tempfile.TemporaryDirectory(dir=self.test_dir) as tmp_dir:
+            # Create a symfs_dir in the test dir, which is more likely on the same file system as
+            # testdata than the system temp dir. Link vmlinux instead of copying it when possible.
+            symfs_dir = Path(tmp_dir)
+            vmlinux = TestHelper.testdata_path('vmlinux')
+            try:
+                os.link(vmlinux, symfs_dir / 'vmlinux')
+            except OSError:
+                shutil.copy(vmlinux, symfs_dir)
+            kernel_build_id = ReadElf(TestHelper.ndk_path).get_build_id(symfs_dir / 'vmlinux')
+            (symfs_dir / 'build_id_list').write_text('%s=vmlinux' % kernel_build_id)
+
+            try:
+                # Check if vmlinux in symfs_dir is used, when we set record file before setting
+                # symfs_dir.
+                self.report_lib.SetRecordFile(record_file)
+                self.report_lib.SetSymfs(str(symfs_dir))
+                sample = self.report_lib.GetNextSample()
+                self.assertIsNotNone(sample)
+                symbol = self.report_lib.GetSymbolOfCurrentSample()
+                self.assertEqual(symbol.dso_name, "[kernel.kallsyms]")
+                # vaddr_in_file and symbol_addr are adjusted after using vmlinux.
+                self.assertEqual(symbol.vaddr_in_file, 0xffffffc008fb3e28)
+                self.assertEqual(symbol.symbol_name, "_raw_spin_unlock_irq")
+                self.assertEqual(symbol.symbol_addr, 0xffffffc008fb3e0c)
+                self.assertEqual(symbol.symbol_len, 0x4c)
+            finally:
+                # Close the lib before removing symfs_dir, even if a check fails, as it may
+                # still have vmlinux open.
+                self.report_lib.Close()
 
     def test_get_process_name(self):
         self.report_lib.SetRecordFile(TestHelper.testdata_path('perf_display_bitmaps.data'))
@@ -429,26 +530,24 @@ class TestReportLib(TestBase):
         self.assertEqual(self.report_lib.GetSymbols("/nonexistent_file.so"), None)
 
 
-class TestProtoFileReportLib(TestBase):
+class TestProtoFileReportLib(ProfilingMixin, TestBase):
     def test_smoke(self):
         report_lib = ProtoFileReportLib()
         report_lib.SetRecordFile(TestHelper.testdata_path('display_bitmaps.proto_data'))
         sample_count = 0
-        while True:
-            sample = report_lib.GetNextSample()
-            if sample is None:
-                report_lib.Close()
-                break
+        while sample := report_lib.GetNextSampleFull():
             sample_count += 1
-            event = report_lib.GetEventOfCurrentSample()
-            self.assertEqual(event.name, 'cpu-clock')
-            report_lib.GetSymbolOfCurrentSample()
-            report_lib.GetCallChainOfCurrentSample()
+            self.assertEqual(sample.event.name, 'cpu-clock')
+            self.assertEqual(report_lib.GetCallChainDsoNamesOfCurrentSample(),
+                             [entry.symbol.dso_name for entry in sample.callchain.entries])
+        report_lib.Close()
         self.assertEqual(sample_count, 525)
 
     def convert_perf_data_to_proto_file(self, perf_data_path: str) -> str:
         simpleperf_path = get_host_binary_path('simpleperf')
-        proto_file_path = 'perf.trace'
+        # Use a unique path, so conversions don't overwrite files still used by other readers.
+        fd, proto_file_path = tempfile.mkstemp(prefix='perf_', suffix='.trace', dir='.')
+        os.close(fd)
         subprocess.check_call([simpleperf_path, 'report-sample', '--show-callchain', '--protobuf',
                                '--remove-gaps', '0', '-i', perf_data_path, '-o', proto_file_path])
         return proto_file_path
@@ -488,24 +587,10 @@ class TestProtoFileReportLib(TestBase):
             report_lib.SetRecordFile(proto_file_path)
             report_lib.SetTraceOffCpuMode(mode)
 
-            cpu_clock_period = 0
-            cpu_clock_samples = 0
-            sched_switch_period = 0
-            sched_switch_samples = 0
-            while report_lib.GetNextSample():
-                sample = report_lib.GetCurrentSample()
-                event = report_lib.GetEventOfCurrentSample()
-                if event.name == 'cpu-clock:u':
-                    cpu_clock_period += sample.period
-                    cpu_clock_samples += 1
-                else:
-                    self.assertEqual(event.name, 'sched:sched_switch')
-                    sched_switch_period += sample.period
-                    sched_switch_samples += 1
-            self.assertEqual(cpu_clock_samples, expected_values['cpu-clock:u'][0])
-            self.assertEqual(cpu_clock_period, expected_values['cpu-clock:u'][1])
-            self.assertEqual(sched_switch_samples, expected_values['sched:sched_switch'][0])
-            self.assertEqual(sched_switch_period, expected_values['sched:sched_switch'][1])
+            event_stats = get_event_stats(report_lib)
+            self.assertLessEqual(set(event_stats), set(expected_values))
+            for event_name, expected_value in expected_values.items():
+                self.assertEqual(event_stats.get(event_name, (0, 0)), expected_value)
 
         # Check trace-offcpu modes on a profile not recorded with --trace-offcpu.
         report_lib.Close()
@@ -17,6 +17,7 @@
 """test_utils.py: utils for testing.
 """
 
+import json
 import logging
 from multiprocessing.connection import Connection
 import os
@@ -41,11 +42,13 @@ class TestHelper:
     def init(
             cls, test_dir: str, testdata_dir: str, use_browser: bool, ndk_path: Optional[str],
             device_serial_number: Optional[str],
-            progress_conn: Optional[Connection]):
+            progress_conn: Optional[Connection],
+            results_file: Optional[str] = None):
         """
             When device_serial_number is None, no Android device is used.
             When device_serial_number is '', use the default Android device.
             When device_serial_number is not empty, select Android device by serial number.
+            When results_file is not None, append a json line to it for each finished test.
         """
         cls.script_dir = Path(__file__).resolve().parents[1]
         cls.test_base_dir = Path(test_dir).resolve()
@@ -54,6 +57,9 @@ class TestHelper:
         cls.browser_option = [] if use_browser else ['--no_browser']
         cls.ndk_path = ndk_path
         cls.progress_conn = progress_conn
+        # Multiple processes can append to the results file. Use line buffering, so each
+        # result is written in one call.
+        cls.results_fh = open(results_file, 'a', buffering=1) if results_file else None
 
         # Logs can come from multiple processes. So use append mode to avoid overwrite.
         cls.log_fh = open(cls.test_base_dir / 'test.log', 'a')
@@ -116,9 +122,16 @@ class TestHelper:
         return (int(m.group(1)), int(m.group(2)))
 
     @classmethod
-    def write_progress(cls, progress: str):
+    def write_progress(cls, test_name: str, status: str, duration: float):
         if cls.progress_conn:
-            cls.progress_conn.send(progress)
+            cls.progress_conn.send((test_name, status, duration))
+
+    @classmethod
+    def write_result(cls, test_name: str, status: str, duration: float):
+        if cls.results_fh:
+            result = {'test': test_name, 'test_dir': cls.test_base_dir.name,
+                      'status': status, 'duration': round(duration, 3)}
+            cls.results_fh.write(json.dumps(result) + '\n')
 
 
 class TestBase(unittest.TestCase):
@@ -154,9 +167,9 @@ class TestBase(unittest.TestCase):
         # Remove test data for passed tests to save space.
         if status == 'OK':
             remove(self.test_dir)
-        TestHelper.write_progress(
-            '%s.%s  %s  %.3fs' %
-            (self.__class__.__name__, self._testMethodName, status, time_taken))
+        test_name = '%s.%s' % (self.__class__.__name__, self._testMethodName)
+        TestHelper.write_result(test_name, status, time_taken)
+        TestHelper.write_progress(test_name, status, time_taken)
         return ret
 
     def run_cmd(self, args: List[str], return_output=False, drop_output=True) -> str: